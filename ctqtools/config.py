@@ -1,18 +1,45 @@
 from __future__ import annotations
 import os
-from typing import Dict, Any
+import re
+from typing import Dict, Any, List, Tuple
 import yaml
 
 
+def compile_protocol_regex(rules: List[Dict[str, Any]] | None) -> List[Tuple[re.Pattern, str]]:
+    compiled = []
+    for rule in rules or []:
+        pat = rule.get("pattern")
+        if not pat:
+            continue
+        compiled.append((re.compile(pat, flags=re.IGNORECASE), rule.get("replace", "")))
+    return compiled
+
+
+def fuse_protocol_regex(compiled: List[Tuple[re.Pattern, str]]) -> re.Pattern | None:
+    # Una sola expresión que prueba las reglas en orden: cada alternativa es un
+    # lookahead (equivale a `search` desde el inicio) seguido de un grupo vacío
+    # con nombre r<i>, así `lastgroup` indica qué regla ganó. Solo se fusiona si
+    # ninguna regla tiene grupos propios (las backreferences cambiarían de número).
+    if not compiled or any(rx.groups for rx, _ in compiled):
+        return None
+    alts = "|".join(f"(?=[\\s\\S]*?(?:{rx.pattern}))(?P<r{i}>)" for i, (rx, _) in enumerate(compiled))
+    try:
+        return re.compile(f"^(?:{alts})", flags=re.IGNORECASE)
+    except re.error:
+        return None
+
+
 def load_config(path: str | None) -> Dict[str, Any]:
     if not path:
-        return {"protocol_map": {}, "protocol_regex": []}
+        return {"protocol_map": {}, "protocol_regex": [], "_compiled_regex": [], "_fused_regex": None}
     if not os.path.exists(path):
-        return {"protocol_map": {}, "protocol_regex": []}
+        return {"protocol_map": {}, "protocol_regex": [], "_compiled_regex": [], "_fused_regex": None}
     with open(path, "r", encoding="utf-8") as f:
         cfg = yaml.safe_load(f) or {}
     cfg.setdefault("protocol_map", {})
     cfg.setdefault("protocol_regex", [])
+    cfg["_compiled_regex"] = compile_protocol_regex(cfg["protocol_regex"])
+    cfg["_fused_regex"] = fuse_protocol_regex(cfg["_compiled_regex"])
     return cfg
 
 
@@ -24,13 +51,18 @@ def normalize_protocol(name: str | None, cfg: Dict[str, Any]) -> str:
     mp = cfg.get("protocol_map", {}) or {}
     if s in mp:
         return str(mp[s])
-    # Regex rules (list of {pattern: , replace: })
-    import re
-    for rule in cfg.get("protocol_regex", []) or []:
-        pat = rule.get("pattern")
-        rep = rule.get("replace", "")
-        if not pat:
-            continue
-        if re.search(pat, s, flags=re.IGNORECASE):
-            return re.sub(pat, rep, s, flags=re.IGNORECASE)
+    # Regex rules (list of {pattern: , replace: }), compiladas en load_config
+    compiled = cfg.get("_compiled_regex")
+    if compiled is None:
+        compiled = compile_protocol_regex(cfg.get("protocol_regex"))
+    fused = cfg.get("_fused_regex")
+    if fused is not None:
+        m = fused.match(s)
+        if not m:
+            return s
+        rx, rep = compiled[int(m.lastgroup[1:])]
+        return rx.sub(rep, s)
+    for rx, rep in compiled:
+        if rx.search(s):
+            return rx.sub(rep, s)
     return s
@@ -1,6 +1,8 @@
+from __future__ import annotations
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, Any, Iterable, List
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+from typing import Dict, Any, Iterable, Iterator, List, Type
 
 import pydicom
 
@@ -35,25 +37,52 @@ DEFAULT_KEYS = [
     "PitchFactor",
 ]
 
+# Claves numéricas: se guardan como int/float nativos en vez de str (IS -> int, DS/FD -> float)
+INT_KEYS = {"SeriesNumber", "InstanceNumber", "ExposureTime", "XRayTubeCurrent", "Exposure"}
+FLOAT_KEYS = {"KVP", "ExposureTimeInms", "SpiralPitchFactor", "PitchFactor"}
+NUMERIC_KEYS = INT_KEYS | FLOAT_KEYS
+
+# Tags numéricos de DEFAULT_KEYS para `specific_tags` (se omiten keywords no estándar).
+_DEFAULT_TAGS = [
+    tag for tag in (pydicom.datadict.tag_for_keyword(k) for k in DEFAULT_KEYS) if tag is not None
+]
+
+
+# VRs binarios: por encima de este tamaño se exporta un marcador en vez del contenido
+BINARY_VRS = {"OB", "OW", "OD", "OF", "OL", "OV", "UN"}
+BINARY_INLINE_MAX = 1024
+
 
 def flatten_dataset(ds: pydicom.Dataset) -> Dict[str, Any]:
     row: Dict[str, Any] = {}
     for elem in ds.iterall():
         try:
             name = elem.keyword or elem.name.replace(" ", "")
-            if elem.VR == "SQ":
+            vr = elem.VR
+            if vr == "SQ":
                 # Serialize sequences to compact JSON-like strings
                 row[name] = f"SQ[{len(elem.value)}]"
                 continue
             val = elem.value
-            row[name] = str(val)
+            if vr in BINARY_VRS and isinstance(val, (bytes, bytearray)) and len(val) > BINARY_INLINE_MAX:
+                row[name] = f"<{vr}:{len(val)}B>"
+                continue
+            row[name] = val if isinstance(val, str) else str(val)
         except Exception:
             continue
     return row
 
 
 def read_metadata(path: str, all_tags: bool = False) -> Dict[str, Any]:
-    ds = pydicom.dcmread(path, stop_before_pixels=True, force=True)
+    # Un solo open: el tamaño sale de fstat sobre el mismo descriptor que lee pydicom
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        ds = pydicom.dcmread(
+            f,
+            stop_before_pixels=True,
+            force=True,
+            specific_tags=None if all_tags else _DEFAULT_TAGS,
+        )
     if all_tags:
         row = flatten_dataset(ds)
     else:
@@ -64,22 +93,40 @@ def read_metadata(path: str, all_tags: bool = False) -> Dict[str, Any]:
                 v = getattr(ds, k, None)
             except Exception:
                 v = None
-            row[k] = str(v) if v is not None else None
+            if v is None:
+                row[k] = None
+            elif k in NUMERIC_KEYS:
+                try:
+                    row[k] = int(v) if k in INT_KEYS else float(v)
+                except (TypeError, ValueError):
+                    # Vacío o multivalor (p.ej. KVP [80, 140]): se conserva como texto.
+                    # La columna queda con tipos mezclados; write_table la pasa a texto.
+                    row[k] = str(v)
+            else:
+                row[k] = str(v)
     row["_path"] = path
-    try:
-        row["_size_bytes"] = os.path.getsize(path)
-    except Exception:
-        row["_size_bytes"] = None
+    row["_size_bytes"] = size
     return row
 
 
+_DIRECTORY_RECORD_SEQUENCE = pydicom.tag.Tag(0x0004, 0x1220)
+_REFERENCED_FILE_ID = pydicom.tag.Tag(0x0004, 0x1500)
+
+
 def iter_files_from_dicomdir(dicomdir_path: str) -> Iterable[str]:
     base_dir = os.path.dirname(os.path.abspath(dicomdir_path))
-    ddir = pydicom.dcmread(dicomdir_path, force=True, stop_before_pixels=True)
+    # Solo la DirectoryRecordSequence; de cada registro se convierte únicamente
+    # ReferencedFileID (el resto de elementos queda sin decodificar)
+    ddir = pydicom.dcmread(
+        dicomdir_path,
+        force=True,
+        stop_before_pixels=True,
+        specific_tags=[_DIRECTORY_RECORD_SEQUENCE],
+    )
     seq = getattr(ddir, "DirectoryRecordSequence", [])
     for rec in seq:
-        if "ReferencedFileID" in rec:
-            ref = rec.ReferencedFileID
+        if _REFERENCED_FILE_ID in rec:
+            ref = rec[_REFERENCED_FILE_ID].value
             if hasattr(ref, "__iter__") and not isinstance(ref, (str, bytes)):
                 rel = os.path.join(*[str(x) for x in list(ref)])
             else:
@@ -90,24 +137,86 @@ def iter_files_from_dicomdir(dicomdir_path: str) -> Iterable[str]:
 
 
 def iter_files_from_folder(root: str) -> Iterable[str]:
-    for dirpath, _, filenames in os.walk(root):
-        for name in filenames:
-            yield os.path.join(dirpath, name)
+    # scandir con pila explícita: DirEntry trae el tipo desde readdir, sin stat extra
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        try:
+            with os.scandir(d) as it:
+                for entry in it:
+                    # Ocultos (.DS_Store, ._*, .Trashes) y el propio DICOMDIR no son instancias
+                    if entry.name.startswith(".") or entry.name.upper() == "DICOMDIR":
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        yield entry.path
+        except OSError:
+            continue
+
+
+def read_metadata_many(paths: List[str], all_tags: bool = False) -> List[Dict[str, Any]]:
+    rows: List[Dict[str, Any]] = []
+    for path in paths:
+        try:
+            rows.append(read_metadata(path, all_tags))
+        except Exception:
+            continue
+    return rows
+
+
+def _chunked(items: Iterable[str], size: int) -> Iterator[List[str]]:
+    it = iter(items)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def build_index(
     inputs: Iterable[str],
     max_workers: int = 8,
     all_tags: bool = False,
-) -> List[Dict[str, Any]]:
-    rows: List[Dict[str, Any]] = []
-    futures = []
-    with ThreadPoolExecutor(max_workers=max_workers) as ex:
-        for path in inputs:
-            futures.append(ex.submit(read_metadata, path, all_tags))
-        for fut in as_completed(futures):
+    executor_cls: Type[Executor] = ThreadPoolExecutor,
+    chunksize: int | None = None,
+) -> Dict[str, List[Any]]:
+    # Ventana deslizante: como máximo 4*max_workers tareas en vuelo, así `inputs`
+    # puede ser un generador y no se crea un Future por archivo de antemano.
+    # Con procesos cada tarea lleva un lote de rutas para amortizar el pickling.
+    # El resultado es columnar (dict de listas), listo para pd.DataFrame(columns).
+    if chunksize is None:
+        chunksize = 32 if issubclass(executor_cls, ProcessPoolExecutor) else 1
+    columns: Dict[str, List[Any]] = {} if all_tags else {k: [] for k in DEFAULT_KEYS + ["_path", "_size_bytes"]}
+    n_rows = 0
+    max_in_flight = max(1, 4 * max_workers)
+
+    def collect(done) -> None:
+        nonlocal n_rows
+        for fut in done:
             try:
-                rows.append(fut.result())
+                batch = fut.result()
             except Exception:
                 continue
-    return rows
+            for row in batch:
+                for k in row:
+                    if k not in columns:
+                        # Tag nuevo (--all-tags): rellenar las filas previas con None
+                        columns[k] = [None] * n_rows
+                for k, col in columns.items():
+                    col.append(row.get(k))
+                n_rows += 1
+
+    with executor_cls(max_workers=max_workers) as ex:
+        pending = set()
+        for chunk in _chunked(inputs, max(1, chunksize)):
+            pending.add(ex.submit(read_metadata_many, chunk, all_tags))
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        done, _ = wait(pending)
+        collect(done)
+    if all_tags:
+        # Igual que en read_metadata: las columnas internas (_path, _size_bytes) al final
+        columns = {k: columns[k] for k in sorted(columns, key=lambda k: k.startswith("_"))}
+    return columns
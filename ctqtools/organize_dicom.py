@@ -1,14 +1,42 @@
 from __future__ import annotations
 import argparse
+import csv
+import errno
 import os
-import shutil
-from typing import List
-
+import queue
+import re
+import threading
+from collections import deque
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterator, List, Tuple
+
+import numpy as np
 import pandas as pd
 
-from .indexer import iter_files_from_dicomdir, iter_files_from_folder, build_index
+from .indexer import INT_KEYS, iter_files_from_dicomdir, iter_files_from_folder, build_index
 from .config import load_config, normalize_protocol
-from .utils import ensure_dir, sanitize
+from .utils import TABLE_FORMATS, copy_file, ensure_dir, sanitize, sanitize_batch, write_table
+
+
+# Columnas de baja cardinalidad usadas como claves de agrupación: como category
+# los groupby trabajan sobre códigos enteros en vez de hashear cada string.
+CAT_COLS = [
+    "PatientID",
+    "PatientName",
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "Modality",
+    "ProtocolName",
+    "ProtocolNorm",
+    "Manufacturer",
+]
+
+# Errores de os.link con los que --prefer-hardlink recurre a copiar (FileExistsError no)
+_LINK_FALLBACK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP}
+
+# Tercer componente de ImagePositionPatient: separadores "," o "\", con o sin corchetes
+_ZPOS_RE = r"^\s*\[?\s*[^,\\\]]+[,\\]\s*[^,\\\]]+[,\\]\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)"
 
 
 def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
@@ -28,11 +56,14 @@ def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
     p.add_argument("--qa", dest="qa", action="store_true", help="Generar reportes de QA")
     p.add_argument("--no-qa", dest="qa", action="store_false", help="No generar reportes de QA")
     p.add_argument("--all-tags", action="store_true", help="Exportar todos los tags (CSV más grande)")
-    p.add_argument("--workers", type=int, default=8, help="Hilos para lectura de metadatos")
+    p.add_argument("--format", choices=list(TABLE_FORMATS), default="csv", help="Formato de las tablas de metadatos; both = csv + parquet (parquet/feather requieren pyarrow)")
+    p.add_argument("--workers", type=int, default=8, help="Hilos/procesos para lectura de metadatos")
+    p.add_argument("--executor", choices=["thread", "process"], default=None, help="Paralelismo para lectura de metadatos (por defecto: process con --all-tags, thread en otro caso)")
     # Organización avanzada
     p.add_argument("--link-mode", choices=["copy", "hardlink", "symlink"], default="copy", help="Modo de materialización de archivos al organizar")
     p.add_argument("--on-collision", choices=["skip", "overwrite", "rename"], default="skip", help="Qué hacer si el destino ya existe")
     p.add_argument("--pad-width", type=int, default=0, help="Padding fijo para nombres secuenciales (0 = auto)")
+    p.add_argument("--prefer-hardlink", action="store_true", help="Con --link-mode copy, intentar primero un enlace duro y copiar solo si falla (otro volumen)")
     p.add_argument("--copy-workers", type=int, default=4, help="Concurrencia para copiado/enlace al organizar")
     # Filtros
     p.add_argument("--modality", action="append", help="Filtrar por Modality (repetible, p.ej. --modality CT)")
@@ -44,71 +75,89 @@ def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
     return p.parse_args(argv)
 
 
-def main(argv: List[str] | None = None) -> int:
-    ns = parse_args(argv)
-    root = os.path.abspath(ns.input)
-    outdir = os.path.abspath(os.path.join(root, ns.output))
-    ensure_dir(outdir)
-
-    # Descubrir archivos
-    dicomdir_candidates = [os.path.join(root, "dicomdir"), os.path.join(root, "DICOMDIR")]
-    inputs = None
-    for c in dicomdir_candidates:
+def _iter_inputs(root: str, dicom_folder: str, seen: set) -> Iterator[str]:
+    # Descubrimiento perezoso: DICOMDIR si existe y referencia algún archivo; si no,
+    # la carpeta dicom/. Se consume a la vez que build_index lee metadatos.
+    # `seen` acumula las rutas emitidas: un mismo archivo nunca se lee dos veces
+    # (DICOMDIR con referencias repetidas) y len(seen) da el total de archivos.
+    paths = None
+    for c in (os.path.join(root, "dicomdir"), os.path.join(root, "DICOMDIR")):
         if os.path.exists(c):
-            inputs = list(iter_files_from_dicomdir(c))
+            it = iter(iter_files_from_dicomdir(c))
+            first = next(it, None)
+            if first is not None:
+                paths = chain([first], it)
             break
-    if not inputs:
-        inputs = list(iter_files_from_folder(os.path.join(root, ns.dicom_folder)))
-
-    # Indexar metadatos
-    rows = build_index(inputs, max_workers=ns.workers, all_tags=ns.all_tags)
-    df = pd.DataFrame(rows)
-    if df.empty:
-        print({
-            "total_files_seen": len(inputs),
-            "indexed_instances": 0,
-            "message": "No se pudieron leer metadatos."
-        })
-        return 0
-
-    # Derivar protocolo normalizado
-    cfg = load_config(ns.config)
-    proto_eff = (df.get("ProtocolName").fillna("") if "ProtocolName" in df.columns else pd.Series([""] * len(df)))
-    if "SeriesDescription" in df.columns:
-        mask_empty = (proto_eff.eq("")) | proto_eff.isna()
-        proto_eff = proto_eff.where(~mask_empty, df["SeriesDescription"].fillna(""))
-    proto_eff = proto_eff.replace("", "NA")
-    df["ProtocolEffective"] = proto_eff
-    df["ProtocolNorm"] = df["ProtocolEffective"].map(lambda x: normalize_protocol(x, cfg))
-
-    # Filtros
-    def apply_filters(df_in: pd.DataFrame) -> pd.DataFrame:
-        df_out = df_in
-        if ns.modality and "Modality" in df_out.columns:
-            df_out = df_out[df_out["Modality"].isin(ns.modality)]
-        if ns.date_range and "StudyDate" in df_out.columns:
-            try:
-                start, end = ns.date_range.split(":", 1)
-                start = start.strip() or "00000101"
-                end = end.strip() or "99991231"
-                df_out = df_out[(df_out["StudyDate"] >= start) & (df_out["StudyDate"] <= end)]
-            except Exception:
-                pass
-        if ns.patient_ids and "PatientID" in df_out.columns:
-            df_out = df_out[df_out["PatientID"].isin(ns.patient_ids)]
-        import re
-        if ns.protocol_include and "ProtocolNorm" in df_out.columns:
-            df_out = df_out[df_out["ProtocolNorm"].astype(str).str.contains(ns.protocol_include, case=False, na=False, regex=True)]
-        if ns.protocol_exclude and "ProtocolNorm" in df_out.columns:
-            df_out = df_out[~df_out["ProtocolNorm"].astype(str).str.contains(ns.protocol_exclude, case=False, na=False, regex=True)]
-        return df_out
-
-    df = apply_filters(df)
-
-    # Garantizar columnas base
-    for col in ["PatientName", "PatientID", "SeriesInstanceUID"]:
-        if col not in df.columns:
-            df[col] = "NA"
+    if paths is None:
+        paths = iter_files_from_folder(os.path.join(root, dicom_folder))
+    for path in paths:
+        if path not in seen:
+            seen.add(path)
+            yield path
+
+
+def _iter_runs(df_sorted: pd.DataFrame, cols: List[str]) -> Iterator[Tuple[tuple, pd.DataFrame]]:
+    # Tramos contiguos con la misma clave en un DataFrame ya ordenado por `cols`.
+    # iloc devuelve vistas: sin la copia por grupo que hace groupby.
+    n = len(df_sorted)
+    if n == 0:
+        return
+    change = np.zeros(n - 1, dtype=bool)
+    for c in cols:
+        # factorize asigna un código a NaN (-1), así los NaN forman un único tramo
+        codes = pd.factorize(df_sorted[c])[0]
+        change |= codes[1:] != codes[:-1]
+    bounds = np.r_[0, np.flatnonzero(change) + 1, n]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        part = df_sorted.iloc[start:end]
+        yield tuple(part[c].iloc[0] for c in cols), part
+
+
+MANIFEST_FIELDS = ["new_name", "original_name", "src_path"]
+
+
+def _write_manifest(path: str, rows: List[dict]) -> None:
+    # manifest.csv con el módulo csv: sin construir un DataFrame para unas pocas filas
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        w.writeheader()
+        w.writerows(rows)
+
+
+def _csv_writer(q: queue.Queue, errors: List[Tuple[str, Exception]]) -> None:
+    # Consume (ruta, DataFrame) o (ruta, filas de manifest) hasta recibir None;
+    # los fallos se acumulan en `errors` para que main termine con código != 0
+    while True:
+        item = q.get()
+        if item is None:
+            break
+        path, frame = item
+        try:
+            if isinstance(frame, list):
+                _write_manifest(path, frame)
+            else:
+                write_table(frame, path)
+        except Exception as e:
+            errors.append((path, e))
+            print({"csv_write_error": path, "error": str(e)})
+
+
+def _organize_and_export(
+    ns: argparse.Namespace,
+    df: pd.DataFrame,
+    outdir: str,
+    table_exts: List[str],
+    write_q: queue.Queue,
+) -> Tuple[int, int, dict]:
+    # Organización, exportación y QA; las tablas se encolan en write_q.
+    # Devuelve (series creadas, archivos copiados, info de QA).
+    def put_table(base_path: str, frame: pd.DataFrame) -> str:
+        # Encola la tabla en cada formato pedido (--format); devuelve la primera ruta
+        paths = [base_path + ext for ext in table_exts]
+        if not ns.dry_run:
+            for path in paths:
+                write_q.put((path, frame))
+        return paths[0]
 
     created = 0
     copied = 0
@@ -122,94 +171,219 @@ def main(argv: List[str] | None = None) -> int:
     ]
 
     if ns.organize:
-        for key, g in df.groupby(series_cols, dropna=False, sort=False):
-            patient_name, patient_id, proto_norm, study_uid, series_uid, series_number = key
-            s_patient = sanitize(str(patient_name))
-            s_proto = sanitize(str(proto_norm))
-            s_seriesnum = sanitize(str(series_number))
-            s_seriesuid = sanitize(str(series_uid))
-
-            test_dirname = f"Prueba_{s_patient}__{s_proto}__Series_{s_seriesnum}_{s_seriesuid}"
-            target_dir = os.path.join(outdir, test_dirname)
-            ensure_dir(target_dir)
-            created += 1
-
-            # Deduplicación por SOPInstanceUID
-            if "SOPInstanceUID" in g.columns:
-                g = g.drop_duplicates(subset=["SOPInstanceUID"], keep="first")
-
-            # Orden
-            if "InstanceNumber" in g.columns:
-                g = g.copy()
-                g["InstanceNumber_num"] = pd.to_numeric(g["InstanceNumber"], errors="coerce")
-                g = g.sort_values(["InstanceNumber_num", "_path"], na_position="first")
+        # Nombres ya presentes en cada target_dir: una foto con scandir la primera vez que
+        # aparece la carpeta y luego solo consultas al set (sin stat por archivo). El set es
+        # uno por carpeta y se comparte entre series: dos grupos pueden caer en el mismo
+        # target_dir (p.ej. nombres que sanitizan igual) mientras las copias del primero
+        # siguen pendientes en el pool. El lock protege las reservas.
+        existing_lock = threading.Lock()
+        existing_by_dir: dict = {}
+
+        def resolve_collision(dst_path: str, existing: set) -> str | None:
+            # Devuelve el destino a usar, o None si hay que omitir el archivo
+            if ns.on_collision == "skip":
+                return None
+            if ns.on_collision == "overwrite":
+                try:
+                    os.remove(dst_path)
+                except FileNotFoundError:
+                    pass
+                return dst_path
+            base, ext = os.path.splitext(dst_path)
+            i = 1
+            with existing_lock:
+                while os.path.basename(f"{base}__{i}{ext}") in existing:
+                    i += 1
+                new_dst = f"{base}__{i}{ext}"
+                existing.add(os.path.basename(new_dst))
+            return new_dst
+
+        def make_link(src_path: str, dst_path: str, dir_fd: int | None) -> None:
+            # Con dir_fd el kernel no vuelve a resolver target_dir en cada enlace
+            name = os.path.basename(dst_path) if dir_fd is not None else dst_path
+            if ns.link_mode == "hardlink":
+                os.link(src_path, name, dst_dir_fd=dir_fd)
             else:
-                if "ImagePositionPatient" in g.columns:
-                    def zpos(val: str) -> float:
+                os.symlink(src_path, name, dir_fd=dir_fd)
+
+        def link_or_copy(src_path: str, dst_path: str) -> None:
+            # --prefer-hardlink: enlace duro sin copiar bytes; copia normal solo si el
+            # enlace no es posible (otro volumen, sin permiso, límite de enlaces)
+            try:
+                os.link(src_path, dst_path)
+                return
+            except OSError as e:
+                if e.errno not in _LINK_FALLBACK_ERRNOS:
+                    raise
+            copy_file(src_path, dst_path)
+
+        def replace_into(src_path: str, dst_path: str) -> None:
+            # --on-collision overwrite en modo copy: se escribe un temporal en la misma
+            # carpeta y se reemplaza con os.replace (atómico). Dos series que caen en el
+            # mismo target_dir nunca escriben a la vez el mismo inode: el destino queda
+            # completo, con la copia que termine última.
+            tmp = f"{dst_path}.part-{os.getpid()}-{threading.get_ident()}"
+            try:
+                try:
+                    os.remove(tmp)
+                except FileNotFoundError:
+                    pass
+                if ns.prefer_hardlink:
+                    link_or_copy(src_path, tmp)
+                else:
+                    copy_file(src_path, tmp)
+                os.replace(tmp, dst_path)
+            except BaseException:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                raise
+
+        def materialize(src_path: str, dst_path: str, dir_fd: int | None, existing: set) -> str | None:
+            try:
+                if ns.link_mode == "copy":
+                    # copy2 sobrescribe sin avisar: aquí sí hace falta comprobar antes
+                    name = os.path.basename(dst_path)
+                    with existing_lock:
+                        collides = name in existing
+                        existing.add(name)
+                    if collides:
+                        if ns.on_collision == "overwrite":
+                            replace_into(src_path, dst_path)
+                            return dst_path
+                        new_dst = resolve_collision(dst_path, existing)
+                        if new_dst is None:
+                            return "skipped"
+                        dst_path = new_dst
+                    if ns.prefer_hardlink:
+                        # Si el destino apareció entretanto, se resuelve como en los enlaces
                         try:
-                            s = str(val)
-                            if s.startswith("["):
-                                import ast
-                                lst = ast.literal_eval(s)
-                                return float(lst[2])
-                            if "\\" in s:
-                                return float(s.split("\\")[2])
-                            parts = s.split(",")
-                            return float(parts[2]) if len(parts) > 2 else float("nan")
-                        except Exception:
-                            return float("nan")
-                    g = g.copy()
-                    g["_zpos"] = g["ImagePositionPatient"].map(zpos)
-                    if g["_zpos"].notna().any():
-                        g = g.sort_values(["_zpos", "_path"], na_position="first")
+                            link_or_copy(src_path, dst_path)
+                        except FileExistsError:
+                            if ns.on_collision == "overwrite":
+                                replace_into(src_path, dst_path)
+                                return dst_path
+                            new_dst = resolve_collision(dst_path, existing)
+                            if new_dst is None:
+                                return "skipped"
+                            dst_path = new_dst
+                            link_or_copy(src_path, dst_path)
+                    else:
+                        copy_file(src_path, dst_path)
+                else:
+                    # Enlaces: intentar directamente y resolver solo si ya existe (una syscall por archivo)
+                    try:
+                        make_link(src_path, dst_path, dir_fd)
+                    except FileExistsError:
+                        new_dst = resolve_collision(dst_path, existing)
+                        if new_dst is None:
+                            return "skipped"
+                        dst_path = new_dst
+                        make_link(src_path, dst_path, dir_fd)
+                return dst_path
+            except Exception:
+                return None
+
+        def finish_series(target_dir: str, dir_fd: int | None, manifest_rows: list, futures: list) -> int:
+            n_ok = 0
+            for base, src, fut in futures:
+                res = fut.result()
+                if res is None:
+                    continue
+                n_ok += 1
+                manifest_rows.append({"new_name": os.path.basename(res), "original_name": base, "src_path": src})
+            if dir_fd is not None:
+                os.close(dir_fd)
+            if not ns.dry_run and manifest_rows:
+                man_csv = os.path.join(target_dir, "manifest.csv")
+                write_q.put((man_csv, manifest_rows))
+            return n_ok
+
+        # Claves de orden calculadas una sola vez sobre df (se retiran tras organizar):
+        # InstanceNumber numérico o, en su defecto, la coordenada z de
+        # ImagePositionPatient ("[x, y, z]", "x\y\z" o "x,y,z") extraída con una regex
+        sort_cols: List[str] = []
+        if "InstanceNumber" in df.columns:
+            df["_InstanceNumber_num"] = pd.to_numeric(df["InstanceNumber"], errors="coerce")
+            sort_cols.append("_InstanceNumber_num")
+        elif "ImagePositionPatient" in df.columns:
+            df["_zpos"] = pd.to_numeric(
+                df["ImagePositionPatient"].astype("string").str.extract(_ZPOS_RE, expand=False),
+                errors="coerce",
+            ).astype("float64")
+            sort_cols.append("_zpos")
+
+        # Un único pool para todas las series; como mucho 64 series con copias
+        # pendientes (cada una retiene su dir_fd hasta terminar)
+        pending_series: deque = deque()
+        with ThreadPoolExecutor(max_workers=max(1, ns.copy_workers)) as copy_ex:
+            # Deduplicación por SOPInstanceUID dentro de cada serie, en una sola pasada
+            # sobre df (df no se toca: QA necesita los duplicados para reportarlos)
+            df_org = df
+            if "SOPInstanceUID" in df.columns:
+                df_org = df[~df.duplicated(subset=series_cols + ["SOPInstanceUID"], keep="first")]
+            # Nombres sanitizados precalculados por valor distinto (categorías) de cada
+            # columna de la clave. Cualquier faltante (NaN, None, pd.NA de Int64) da "nan",
+            # como antes de la conversión a Int64: el layout no depende del dtype ni de --all-tags
+            dir_names = {}
+            for col in dict.fromkeys(series_cols):
+                vals = df_org[col]
+                uniq = vals.cat.categories if isinstance(vals.dtype, pd.CategoricalDtype) else vals.dropna().unique()
+                dir_names[col] = dict(zip(uniq, sanitize_batch(uniq)))
+
+            def dir_part(col: str, val) -> str:
+                if pd.isna(val):
+                    return "nan"
+                return dir_names[col][val]
+
+            for key, g in df_org.groupby(series_cols, dropna=False, sort=False, observed=True):
+                patient_name, patient_id, proto_norm, study_uid, series_uid, series_number = key
+                s_patient = dir_part("PatientName", patient_name)
+                s_proto = dir_part("ProtocolNorm", proto_norm)
+                s_seriesnum = dir_part(series_cols[5], series_number)
+                s_seriesuid = dir_part("SeriesInstanceUID", series_uid)
+
+                test_dirname = f"Prueba_{s_patient}__{s_proto}__Series_{s_seriesnum}_{s_seriesuid}"
+                target_dir = os.path.join(outdir, test_dirname)
+                ensure_dir(target_dir)
+                created += 1
+                existing = existing_by_dir.get(target_dir)
+                if existing is None:
+                    with os.scandir(target_dir) as it:
+                        existing = existing_by_dir[target_dir] = {e.name for e in it}
+
+                # Orden
+                if "_InstanceNumber_num" in g.columns:
+                    g = g.sort_values(["_InstanceNumber_num", "_path"], na_position="first")
+                else:
+                    if "_zpos" in g.columns:
+                        if g["_zpos"].notna().any():
+                            g = g.sort_values(["_zpos", "_path"], na_position="first")
+                        elif "AcquisitionTime" in g.columns:
+                            g = g.sort_values(["AcquisitionTime", "_path"])  # simple fallback temporal
+                        else:
+                            g = g.sort_values(["_path"])  # fallback
                     elif "AcquisitionTime" in g.columns:
-                        g = g.sort_values(["AcquisitionTime", "_path"])  # simple fallback temporal
+                        g = g.sort_values(["AcquisitionTime", "_path"])  # fallback temporal
                     else:
                         g = g.sort_values(["_path"])  # fallback
-                elif "AcquisitionTime" in g.columns:
-                    g = g.sort_values(["AcquisitionTime", "_path"])  # fallback temporal
-                else:
-                    g = g.sort_values(["_path"])  # fallback
-
-            total = len(g)
-            pad = ns.pad_width if ns.pad_width and ns.pad_width > 0 else max(4, len(str(total)))
 
-            from concurrent.futures import ThreadPoolExecutor
+                total = len(g)
+                pad = ns.pad_width if ns.pad_width and ns.pad_width > 0 else max(4, len(str(total)))
 
-            def materialize(src_path: str, dst_path: str) -> str | None:
-                # Colisiones
-                if os.path.exists(dst_path):
-                    if ns.on_collision == "skip":
-                        return "skipped"
-                    elif ns.on_collision == "overwrite":
+                dir_fd = None
+                if not ns.dry_run and ns.link_mode != "copy":
+                    func = os.link if ns.link_mode == "hardlink" else os.symlink
+                    if func in os.supports_dir_fd:
                         try:
-                            os.remove(dst_path)
-                        except FileNotFoundError:
-                            pass
-                    elif ns.on_collision == "rename":
-                        base, ext = os.path.splitext(dst_path)
-                        i = 1
-                        new_dst = f"{base}__{i}{ext}"
-                        while os.path.exists(new_dst):
-                            i += 1
-                            new_dst = f"{base}__{i}{ext}"
-                        dst_path = new_dst
-                try:
-                    if ns.link_mode == "copy":
-                        shutil.copy2(src_path, dst_path)
-                    elif ns.link_mode == "hardlink":
-                        os.link(src_path, dst_path)
-                    else:
-                        os.symlink(src_path, dst_path)
-                    return dst_path
-                except Exception:
-                    return None
+                            dir_fd = os.open(target_dir, os.O_RDONLY)
+                        except OSError:
+                            dir_fd = None
 
-            manifest_rows = []
-            with ThreadPoolExecutor(max_workers=max(1, ns.copy_workers)) as ex:
+                manifest_rows = []
                 futures = []
-                for idx, (_, row) in enumerate(g.iterrows(), start=1):
-                    src = row.get("_path")
+                for idx, src in enumerate(g["_path"].to_numpy(), start=1):
                     if not src or not os.path.exists(str(src)):
                         continue
                     src = str(src)
@@ -221,40 +395,37 @@ def main(argv: List[str] | None = None) -> int:
                         copied += 1
                         manifest_rows.append({"new_name": new_name, "original_name": base, "src_path": src})
                         continue
-                    futures.append((base, new_name, src, ex.submit(materialize, src, dst)))
+                    futures.append((base, src, copy_ex.submit(materialize, src, dst, dir_fd, existing)))
 
-                for base, new_name, src, fut in futures:
-                    res = fut.result()
-                    if res is None:
-                        continue
-                    copied += 1
-                    manifest_rows.append({"new_name": os.path.basename(res), "original_name": base, "src_path": src})
+                pending_series.append((target_dir, dir_fd, manifest_rows, futures))
+                if len(pending_series) > 64:
+                    copied += finish_series(*pending_series.popleft())
 
-            if not ns.dry_run and manifest_rows:
-                man_csv = os.path.join(target_dir, "manifest.csv")
-                pd.DataFrame(manifest_rows).to_csv(man_csv, index=False)
+            while pending_series:
+                copied += finish_series(*pending_series.popleft())
+        df.drop(columns=sort_cols, inplace=True)
 
     # Exportar metadatos y QA
     outputs = {}
     if ns.export_metadata:
-        inst_csv = os.path.join(outdir, "global_index_instances.csv")
-        if not ns.dry_run:
-            df.to_csv(inst_csv, index=False)
-        outputs["instances_csv"] = inst_csv
+        outputs["instances_csv"] = put_table(os.path.join(outdir, "global_index_instances"), df)
 
         s_cols = ["PatientID", "StudyInstanceUID", "SeriesInstanceUID", "SeriesNumber" if "SeriesNumber" in df.columns else "SeriesInstanceUID", "ProtocolNorm", "Modality" if "Modality" in df.columns else None]
         s_cols = [c for c in s_cols if c and c in df.columns]  # type: ignore
-        grp = df.groupby(s_cols, dropna=False, sort=False)
+        grp = df.groupby(s_cols, dropna=False, sort=False, observed=True)
         base_col = "SOPInstanceUID" if "SOPInstanceUID" in df.columns else (s_cols[0] if s_cols else df.columns[0])
-        series_df = grp.agg(
-            n_instances=(base_col, "count"),
-            instance_min=("InstanceNumber" if "InstanceNumber" in df.columns else base_col, "min"),
-            instance_max=("InstanceNumber" if "InstanceNumber" in df.columns else base_col, "max"),
-        ).reset_index()
-        series_csv = os.path.join(outdir, "global_index_series.csv")
-        if not ns.dry_run:
-            series_df.to_csv(series_csv, index=False)
-        outputs["series_csv"] = series_csv
+        counts = grp[base_col].count().rename("n_instances")
+        if "InstanceNumber" in df.columns:
+            # min/max numéricos (como texto "10" < "9") en una sola pasada Cython
+            inums = pd.to_numeric(df["InstanceNumber"], errors="coerce")
+            if (inums.dropna() % 1 == 0).all():
+                inums = inums.astype("Int64")
+            mm = inums.groupby([df[c] for c in s_cols], dropna=False, sort=False, observed=True).agg(["min", "max"])
+        else:
+            mm = grp[base_col].agg(["min", "max"])
+        mm.columns = ["instance_min", "instance_max"]
+        series_df = pd.concat([counts, mm], axis=1).reset_index()
+        outputs["series_csv"] = put_table(os.path.join(outdir, "global_index_series"), series_df)
 
         csv_dir_pat = os.path.join(outdir, "csv", "patients")
         csv_dir_pp = os.path.join(outdir, "csv", "patient_protocols")
@@ -263,21 +434,25 @@ def main(argv: List[str] | None = None) -> int:
             ensure_dir(csv_dir_pp)
 
         if "PatientID" in df.columns:
-            for pid, g in df.groupby("PatientID", dropna=False, sort=False):
+            # Particionar series_df una sola vez en lugar de filtrarlo por cada paciente
+            series_by_pid = {}
+            if "PatientID" in series_df.columns:
+                series_by_pid = {str(pid): ssub for pid, ssub in series_df.groupby("PatientID", dropna=False, sort=False, observed=True)}
+            # Un solo orden (paciente, protocolo): cada paciente es un tramo contiguo y,
+            # dentro de él, cada protocolo también; ambos niveles salen de la misma pasada
+            has_proto = "ProtocolNorm" in df.columns
+            df_by_pp = df.sort_values(["PatientID", "ProtocolNorm"] if has_proto else ["PatientID"], kind="stable")
+            for (pid,), g in _iter_runs(df_by_pp, ["PatientID"]):
                 spid = sanitize(str(pid))
-                if not ns.dry_run:
-                    g.to_csv(os.path.join(csv_dir_pat, f"patient_{spid}_instances.csv"), index=False)
+                put_table(os.path.join(csv_dir_pat, f"patient_{spid}_instances"), g)
                 if "PatientID" in series_df.columns:
-                    ssub = series_df[series_df["PatientID"] == pid]
-                    if not ns.dry_run:
-                        ssub.to_csv(os.path.join(csv_dir_pat, f"patient_{spid}_series.csv"), index=False)
-
-        if "PatientID" in df.columns and "ProtocolNorm" in df.columns:
-            for (pid, proto), g in df.groupby(["PatientID", "ProtocolNorm"], dropna=False, sort=False):
-                spid = sanitize(str(pid))
-                sproto = sanitize(str(proto))
-                if not ns.dry_run:
-                    g.to_csv(os.path.join(csv_dir_pp, f"patient_{spid}__protocol_{sproto}_instances.csv"), index=False)
+                    ssub = series_by_pid.get(str(pid), series_df.iloc[0:0])
+                    put_table(os.path.join(csv_dir_pat, f"patient_{spid}_series"), ssub)
+                if not has_proto:
+                    continue
+                for (proto,), gp in _iter_runs(g, ["ProtocolNorm"]):
+                    sproto = sanitize(str(proto))
+                    put_table(os.path.join(csv_dir_pp, f"patient_{spid}__protocol_{sproto}_instances"), gp)
 
     qa_info = {}
     if ns.qa and ns.export_metadata and not ns.dry_run:
@@ -300,18 +475,12 @@ def main(argv: List[str] | None = None) -> int:
 
             work = df.copy()
             # Normalizar tiempo de exposición en ms (prioriza ExposureTimeInms)
-            import pandas as _pd
-            def _to_float(x):
-                try:
-                    return float(str(x))
-                except Exception:
-                    return _pd.NA
             if "ExposureTimeInms" in work.columns:
-                work["_ExposureTime_ms"] = work["ExposureTimeInms"].map(_to_float)
+                work["_ExposureTime_ms"] = pd.to_numeric(work["ExposureTimeInms"], errors="coerce").astype("float64")
             else:
-                work["_ExposureTime_ms"] = _pd.NA
+                work["_ExposureTime_ms"] = np.nan
             if "ExposureTime" in work.columns:
-                et_as_ms = work["ExposureTime"].map(_to_float)
+                et_as_ms = pd.to_numeric(work["ExposureTime"], errors="coerce").astype("float64")
                 work["_ExposureTime_ms"] = work["_ExposureTime_ms"].fillna(et_as_ms)
 
             # Pitch efectivo por fila (SpiralPitchFactor > PitchFactor)
@@ -323,11 +492,7 @@ def main(argv: List[str] | None = None) -> int:
             if pitch_cols:
                 work["_Pitch"] = work[pitch_cols].bfill(axis=1).iloc[:, 0]
             else:
-                work["_Pitch"] = _pd.NA
-
-            def uniq_join(series):
-                vals = [str(v) for v in series.dropna().astype(str).unique() if str(v).strip() not in ("", "None", "nan")]
-                return " | ".join(sorted(vals)) if vals else ""
+                work["_Pitch"] = pd.NA
 
             grp_cols = ["PatientID", "ProtocolNorm"]
             if "PatientName" in work.columns:
@@ -336,18 +501,47 @@ def main(argv: List[str] | None = None) -> int:
             else:
                 grp_cols_display = grp_cols
 
-            g = work.groupby(grp_cols, dropna=False, sort=False)
+            g = work.groupby(grp_cols, dropna=False, sort=False, observed=True)
             summary = g.agg(
                 n_series=("SeriesInstanceUID", "nunique") if "SeriesInstanceUID" in work.columns else ("SOPInstanceUID", "nunique"),
                 n_instances=("SOPInstanceUID", "count") if "SOPInstanceUID" in work.columns else (work.columns[0], "count"),
-                kernel=("ConvolutionKernel", uniq_join) if "ConvolutionKernel" in work.columns else (work.columns[0], lambda s: ""),
-                kvp=("KVP", uniq_join) if "KVP" in work.columns else (work.columns[0], lambda s: ""),
-                exposure_time_ms=("_ExposureTime_ms", uniq_join),
-                xray_tube_current_mA=("XRayTubeCurrent", uniq_join) if "XRayTubeCurrent" in work.columns else (work.columns[0], lambda s: ""),
-                exposure_mAs=("Exposure", uniq_join) if "Exposure" in work.columns else (work.columns[0], lambda s: ""),
-                pitch=("_Pitch", uniq_join),
             ).reset_index()
 
+            # Valores únicos por grupo unidos con " | ": se deduplican pares (grupo, valor)
+            # de forma vectorizada y solo se ordena/une la lista corta de cada grupo
+            gid = g.ngroup().to_numpy()
+
+            def uniq_join(col: str, trim_int: bool = False) -> np.ndarray:
+                # trim_int: floats enteros sin ".0" (KVP 120, no 120.0), como el texto DICOM.
+                # Se decide por valor: las columnas pueden ser object (floats junto a textos)
+                out = np.full(len(summary), "", dtype=object)
+                if col not in work.columns:
+                    return out
+                s_col = work[col]
+                valid = s_col.notna().to_numpy()
+                raw = s_col[valid]
+
+                def fmt(v) -> str:
+                    if trim_int and isinstance(v, (float, np.floating)) and float(v).is_integer():
+                        return str(int(v))
+                    return str(v)
+
+                # Formatear cada valor distinto una sola vez
+                text = {u: fmt(u) for u in pd.unique(raw)}
+                vals = raw.map(text).astype(object)
+                keep = ~vals.str.strip().isin(["", "None", "nan"]).to_numpy()
+                pairs = pd.DataFrame({"gid": gid[valid][keep], "v": vals.to_numpy()[keep]}).drop_duplicates()
+                for k, vs in pairs.groupby("gid")["v"]:
+                    out[k] = " | ".join(sorted(vs))
+                return out
+
+            summary["kernel"] = uniq_join("ConvolutionKernel")
+            summary["kvp"] = uniq_join("KVP", trim_int=True)
+            summary["exposure_time_ms"] = uniq_join("_ExposureTime_ms")
+            summary["xray_tube_current_mA"] = uniq_join("XRayTubeCurrent")
+            summary["exposure_mAs"] = uniq_join("Exposure")
+            summary["pitch"] = uniq_join("_Pitch")
+
             # Reordenar columnas para legibilidad
             desired = []
             for c in ["PatientID", "PatientName", "ProtocolNorm", "n_series", "n_instances", "kernel", "kvp", "exposure_time_ms", "xray_tube_current_mA", "exposure_mAs", "pitch"]:
@@ -358,13 +552,124 @@ def main(argv: List[str] | None = None) -> int:
             out_dir_pp = os.path.join(outdir, "csv", "patient_protocols")
             ensure_dir(out_dir_pp)
             out_summary = os.path.join(out_dir_pp, "summary_ct_params_by_patient_protocol.csv")
-            summary.to_csv(out_summary, index=False)
+            write_q.put((out_summary, summary))
             outputs["ct_params_summary_csv"] = out_summary
     except Exception:
         pass
 
+    return created, copied, qa_info
+
+
+def main(argv: List[str] | None = None) -> int:
+    ns = parse_args(argv)
+    if ns.format != "csv":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            print({"error": f"--format {ns.format} requiere pyarrow (pip install pyarrow)"})
+            return 1
+    table_exts = TABLE_FORMATS[ns.format]
+    root = os.path.abspath(ns.input)
+    outdir = os.path.abspath(os.path.join(root, ns.output))
+    ensure_dir(outdir)
+
+    # Descubrir archivos e indexar metadatos en streaming
+    seen_paths: set = set()
+    executor = ns.executor or ("process" if ns.all_tags else "thread")
+    columns = build_index(
+        _iter_inputs(root, ns.dicom_folder, seen_paths),
+        max_workers=ns.workers,
+        all_tags=ns.all_tags,
+        executor_cls=ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor,
+    )
+    df = pd.DataFrame(columns)
+    if df.empty:
+        print({
+            "total_files_seen": len(seen_paths),
+            "indexed_instances": 0,
+            "message": "No se pudieron leer metadatos."
+        })
+        return 0
+
+    # Enteros con huecos: Int64 nullable para no degradarlos a float (p.ej. "Series_1.0").
+    # Con --all-tags las columnas son texto tal cual se leyeron: no se convierten.
+    for k in ([] if ns.all_tags else INT_KEYS):
+        if k in df.columns:
+            try:
+                df[k] = df[k].astype("Int64")
+            except (TypeError, ValueError):
+                pass
+
+    # Derivar protocolo normalizado
+    cfg = load_config(ns.config)
+    proto_eff = (df.get("ProtocolName").fillna("") if "ProtocolName" in df.columns else pd.Series([""] * len(df)))
+    if "SeriesDescription" in df.columns:
+        mask_empty = (proto_eff.eq("")) | proto_eff.isna()
+        proto_eff = proto_eff.where(~mask_empty, df["SeriesDescription"].fillna(""))
+    proto_eff = proto_eff.replace("", "NA")
+    df["ProtocolEffective"] = proto_eff
+    # Normalizar solo los valores únicos y mapear de vuelta con un dict
+    proto_map = {u: normalize_protocol(u, cfg) for u in df["ProtocolEffective"].unique()}
+    df["ProtocolNorm"] = df["ProtocolEffective"].map(proto_map)
+
+    for c in CAT_COLS:
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+
+    # Filtros (regex de protocolo compiladas una sola vez)
+    include_re = re.compile(ns.protocol_include, re.IGNORECASE) if ns.protocol_include else None
+    exclude_re = re.compile(ns.protocol_exclude, re.IGNORECASE) if ns.protocol_exclude else None
+
+    def protocol_mask(col: pd.Series, rx: "re.Pattern[str]") -> pd.Series:
+        # Evaluar la regex solo sobre los valores distintos (categorías) y mapear con isin
+        col_str = col.astype(str)
+        hits = [u for u in pd.unique(col_str) if rx.search(u)]
+        return col_str.isin(hits)
+
+    def apply_filters(df_in: pd.DataFrame) -> pd.DataFrame:
+        df_out = df_in
+        if ns.modality and "Modality" in df_out.columns:
+            df_out = df_out[df_out["Modality"].isin(ns.modality)]
+        if ns.date_range and "StudyDate" in df_out.columns:
+            try:
+                start, end = ns.date_range.split(":", 1)
+                start = start.strip() or "00000101"
+                end = end.strip() or "99991231"
+                df_out = df_out[(df_out["StudyDate"] >= start) & (df_out["StudyDate"] <= end)]
+            except Exception:
+                pass
+        if ns.patient_ids and "PatientID" in df_out.columns:
+            df_out = df_out[df_out["PatientID"].isin(ns.patient_ids)]
+        if include_re is not None and "ProtocolNorm" in df_out.columns:
+            df_out = df_out[protocol_mask(df_out["ProtocolNorm"], include_re)]
+        if exclude_re is not None and "ProtocolNorm" in df_out.columns:
+            df_out = df_out[~protocol_mask(df_out["ProtocolNorm"], exclude_re)]
+        return df_out
+
+    df = apply_filters(df)
+
+    # Garantizar columnas base
+    for col in ["PatientName", "PatientID", "SeriesInstanceUID"]:
+        if col not in df.columns:
+            df[col] = "NA"
+
+    # Escritura de CSVs en segundo plano; la cola acotada frena si el disco no da abasto
+    write_q: queue.Queue = queue.Queue(maxsize=8)
+    write_errors: List[Tuple[str, Exception]] = []
+    writer = threading.Thread(target=_csv_writer, args=(write_q, write_errors), daemon=True)
+    writer.start()
+    try:
+        created, copied, qa_info = _organize_and_export(ns, df, outdir, table_exts, write_q)
+    finally:
+        # Vaciar la cola aunque algo falle: el hilo termina sus escrituras antes de salir
+        write_q.put(None)
+        writer.join()
+    if write_errors:
+        print({"error": "No se pudieron escribir algunas tablas", "failed_writes": [p for p, _ in write_errors]})
+        return 1
+
     print({
-        "total_files_seen": len(inputs),
+        "total_files_seen": len(seen_paths),
         "indexed_instances": len(df),
         "tests_created": created if ns.organize else 0,
         "files_copied": copied if ns.organize else 0,
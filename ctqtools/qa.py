@@ -1,14 +1,17 @@
 from __future__ import annotations
 import os
 from typing import Dict, Any, Tuple
+import numpy as np
 import pandas as pd
 
+from .utils import write_csv
+
 
 def summarize_hierarchy(df: pd.DataFrame) -> pd.DataFrame:
     keys = [k for k in ["PatientID", "StudyInstanceUID", "SeriesInstanceUID", "ProtocolName", "SeriesDescription"] if k in df.columns]
     if not keys:
         return pd.DataFrame()
-    grp = df.groupby(keys, dropna=False)
+    grp = df.groupby(keys, dropna=False, observed=True)
     out = grp.agg(
         n_instances=("SOPInstanceUID" if "SOPInstanceUID" in df.columns else df.columns[0], "count")
     ).reset_index()
@@ -25,27 +28,31 @@ def detect_duplicates(df: pd.DataFrame) -> pd.DataFrame:
 def detect_instance_gaps(df: pd.DataFrame) -> pd.DataFrame:
     if "InstanceNumber" not in df.columns or "SeriesInstanceUID" not in df.columns:
         return pd.DataFrame()
-    # Work on numeric InstanceNumber
-    tmp = df.copy()
-    tmp["InstanceNumber_num"] = pd.to_numeric(tmp["InstanceNumber"], errors="coerce")
-    recs = []
-    for sid, g in tmp.groupby("SeriesInstanceUID", dropna=False):
-        nums = g["InstanceNumber_num"].dropna().astype(int).sort_values().tolist()
-        if not nums:
-            continue
-        expected = set(range(nums[0], nums[-1] + 1))
-        actual = set(nums)
-        missing = sorted(expected - actual)
-        recs.append({
-            "SeriesInstanceUID": sid,
-            "min": nums[0],
-            "max": nums[-1],
-            "n_expected": len(expected),
-            "n_actual": len(actual),
-            "n_missing": len(missing),
-            "missing_list": ",".join(map(str, missing[:50])) + ("…" if len(missing) > 50 else ""),
-        })
-    return pd.DataFrame(recs)
+    # Work on numeric InstanceNumber (truncated to int, as before)
+    nums = pd.to_numeric(df["InstanceNumber"], errors="coerce")
+    valid = nums.notna()
+    if not valid.any():
+        return pd.DataFrame()
+    tmp = pd.DataFrame({
+        "SeriesInstanceUID": df.loc[valid, "SeriesInstanceUID"],
+        "n": nums[valid].astype("int64"),
+    })
+    grp = tmp.groupby("SeriesInstanceUID", dropna=False, observed=True)
+    # Conteos vectorizados; la lista de faltantes solo se arma para series con huecos
+    out = grp["n"].agg(["min", "max", "nunique"]).rename(columns={"nunique": "n_actual"})
+    out["n_expected"] = out["max"] - out["min"] + 1
+    out["n_missing"] = out["n_expected"] - out["n_actual"]
+    out["missing_list"] = ""
+    gap_pos = np.flatnonzero(out["n_missing"].to_numpy() > 0)
+    if len(gap_pos):
+        tmp["_g"] = grp.ngroup()
+        sub = tmp[tmp["_g"].isin(gap_pos)]
+        col = out.columns.get_loc("missing_list")
+        for pos, g in sub.groupby("_g")["n"]:
+            missing = sorted(set(range(int(g.min()), int(g.max()) + 1)) - set(g.tolist()))
+            out.iat[pos, col] = ",".join(map(str, missing[:50])) + ("…" if len(missing) > 50 else "")
+    out = out.reset_index()
+    return out[["SeriesInstanceUID", "min", "max", "n_expected", "n_actual", "n_missing", "missing_list"]]
 
 
 def missing_critical_tags(df: pd.DataFrame) -> pd.DataFrame:
@@ -53,9 +60,9 @@ def missing_critical_tags(df: pd.DataFrame) -> pd.DataFrame:
     present = [c for c in crit if c in df.columns]
     if not present:
         return pd.DataFrame()
-    mask = False
-    for c in present:
-        mask = mask | df[c].isna() | (df[c].astype(str) == "") if isinstance(mask, pd.Series) else (df[c].isna() | (df[c].astype(str) == ""))
+    sub = df[present]
+    # eq("") directo: sin astype(str), que copia cada columna a texto
+    mask = sub.isna().any(axis=1) | sub.eq("").any(axis=1)
     return df.loc[mask, present + (["_path"] if "_path" in df.columns else [])]
 
 
@@ -71,19 +78,19 @@ def run_qa(df_inst: pd.DataFrame, outdir: str) -> Dict[str, Any]:
     paths: Dict[str, str] = {}
     if not hierarchy.empty:
         p = os.path.join(qa_dir, "qa_hierarchy_counts.csv")
-        hierarchy.to_csv(p, index=False)
+        write_csv(hierarchy, p)
         paths["hierarchy_counts"] = p
     if not dups.empty:
         p = os.path.join(qa_dir, "qa_duplicates_sop.csv")
-        dups.to_csv(p, index=False)
+        write_csv(dups, p)
         paths["duplicates_sop"] = p
     if not gaps.empty:
         p = os.path.join(qa_dir, "qa_instance_gaps.csv")
-        gaps.to_csv(p, index=False)
+        write_csv(gaps, p)
         paths["instance_gaps"] = p
     if not missing.empty:
         p = os.path.join(qa_dir, "qa_missing_critical_tags.csv")
-        missing.to_csv(p, index=False)
+        write_csv(missing, p)
         paths["missing_critical_tags"] = p
 
     return {
@@ -1,23 +1,142 @@
 import os
 import json
+import functools
 import re
+import shutil
 from typing import Any
 
+import numpy as np
+import pandas as pd
 
+try:  # opcional: escritor CSV en C++ (pip install -e .[parquet])
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+
+_WHITESPACE_RE = re.compile(r"[\s]+")
+_ALNUM = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
+
+class _DisallowedToUnderscore(dict):
+    # Tabla para str.translate: todo código no presente (no permitido) pasa a "_"
+    def __missing__(self, codepoint: int) -> str:
+        self[codepoint] = "_"
+        return "_"
+
+
+@functools.lru_cache(maxsize=None)
+def _sanitize_table(keep: str) -> _DisallowedToUnderscore:
+    return _DisallowedToUnderscore({ord(ch): ord(ch) for ch in _ALNUM + keep})
+
+
+@functools.lru_cache(maxsize=4096)
 def sanitize(text: str, keep: str = "-_. ") -> str:
     if text is None:
         return "NA"
     t = str(text)
     t = t.strip()
-    t = re.sub(r"[\s]+", " ", t)
-    allowed = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789" + keep)
-    return "".join(ch if ch in allowed else "_" for ch in t)
+    t = _WHITESPACE_RE.sub(" ", t)
+    return t.translate(_sanitize_table(keep))
+
+
+def sanitize_batch(values: Any, keep: str = "-_. ") -> np.ndarray:
+    # Equivale a [sanitize(str(v)) for v in values], pero sanitiza cada valor distinto
+    # una sola vez y expande con los códigos de factorize. factorize junta todos los
+    # faltantes (None, NaN, pd.NA) en el código -1: esos se sanitizan uno a uno para
+    # conservar su forma textual ("None", "nan", "_NA_").
+    ser = pd.Series(values, dtype=object)
+    codes, uniques = pd.factorize(ser)
+    cleaned = np.array([sanitize(str(u), keep) for u in uniques] + [""], dtype=object)[codes]
+    missing = np.flatnonzero(codes == -1)
+    for i in missing:
+        cleaned[i] = sanitize(str(ser.iloc[i]), keep)
+    return cleaned
+
+
+# Extensiones a escribir por cada valor de --format
+TABLE_FORMATS = {
+    "csv": [".csv"],
+    "parquet": [".parquet"],
+    "feather": [".feather"],
+    "both": [".csv", ".parquet"],
+}
+
+
+# Tipos inferidos de columnas object que Arrow no puede convertir a un solo tipo
+_MIXED_KINDS = {"mixed", "mixed-integer"}
+
+
+def single_typed(df: pd.DataFrame) -> pd.DataFrame:
+    # Columnas object con tipos mezclados (p.ej. 120.0 junto a "[120, 140]" en --all-tags)
+    # pasan a texto; el resto queda igual. Sin cambios no se copia el DataFrame.
+    mixed = [
+        c for c in df.columns
+        if df[c].dtype == object and pd.api.types.infer_dtype(df[c], skipna=True) in _MIXED_KINDS
+    ]
+    if not mixed:
+        return df
+    return df.astype({c: "string" for c in mixed})
+
+
+def write_table(df: pd.DataFrame, path: str) -> None:
+    # El formato se decide por la extensión (.csv, .parquet, .feather)
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".parquet", ".feather"):
+        try:
+            if ext == ".parquet":
+                single_typed(df).to_parquet(path, engine="pyarrow", compression="zstd", index=False)
+            else:
+                # to_feather exige un índice por defecto (los slices conservan el original)
+                single_typed(df).reset_index(drop=True).to_feather(path)
+        except Exception:
+            # No dejar un archivo vacío o a medias que parezca válido
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            raise
+    else:
+        write_csv(df, path)
+
+
+def write_csv(df: pd.DataFrame, path: str) -> None:
+    # Con pyarrow se usa su escritor CSV (C++, multihilo) para todas las tablas;
+    # pandas solo si pyarrow no está instalado. Así el formato (comillas en textos,
+    # 120 en vez de 120.0) es el mismo en todos los CSV de una ejecución.
+    if pa is None:
+        df.to_csv(path, index=False)
+        return
+    table = pa.Table.from_pandas(single_typed(df), preserve_index=False)
+    pa_csv.write_csv(table, path)
 
 
 def ensure_dir(path: str) -> None:
     os.makedirs(path, exist_ok=True)
 
 
+def copy_file(src: str, dst: str) -> None:
+    # Igual que shutil.copy2, pero en Linux copia con copy_file_range: el kernel
+    # copia sin pasar por espacio de usuario (y comparte bloques en btrfs/xfs).
+    # Si no está disponible o falla (p.ej. kernels antiguos), vuelve a copy2.
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if n == 0:
+                        break
+                    remaining -= n
+            if remaining == 0:
+                shutil.copystat(src, dst)
+                return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+
 def to_json(value: Any) -> str:
     try:
         return json.dumps(value, ensure_ascii=False)